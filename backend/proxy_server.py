@@ -1,42 +1,267 @@
 from aiohttp import web
 import aiohttp
+from multidict import CIMultiDict
 import tldextract
+import ahocorasick
 import asyncio
+import os
 import socket
 import logging
-import json
-from typing import Set, Dict, Any
+import orjson
+import functools
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from typing import Dict, Any, Optional
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Marks a node in the domain trie as the end of a blocked domain; labels
+# never contain dots, so this cannot collide with a real label
+_TRIE_END = '.'
+
+# Copy size and kernel buffer size for CONNECT tunnels
+TUNNEL_BUFFER_SIZE = 65536
+
+# Headers that only apply to a single connection and must not be forwarded
+# in either direction
+HOP_BY_HOP = frozenset({
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailers', 'transfer-encoding', 'upgrade', 'host'
+})
+
+# CORS headers, built once instead of per request
+_ACAO = '*'
+_PREFLIGHT_HEADERS = CIMultiDict({
+    'Access-Control-Allow-Origin': _ACAO,
+    'Access-Control-Allow-Methods': '*',
+    'Access-Control-Allow-Headers': '*',
+    'Access-Control-Max-Age': '86400',
+})
+
+# Chunk size for streaming upstream response bodies
+STREAM_CHUNK_SIZE = 65536
+
+# Number of URLs whose block decision is remembered
+DECISION_CACHE_SIZE = 16384
+
+# Messages queued per UI client before the oldest ones are dropped
+CLIENT_QUEUE_SIZE = 64
+
+# Shared extractor using the bundled Public Suffix List snapshot, so host
+# parsing never fetches the list over the network mid-request
+_tld = tldextract.TLDExtract(suffix_list_urls=(), include_psl_private_domains=False)
+
+def _hop_by_hop(headers) -> frozenset:
+    """Return the hop-by-hop header names for one message
+
+    Besides the fixed HOP_BY_HOP names, any header listed in the message's
+    Connection header is connection-scoped too (RFC 7230 section 6.1).
+    """
+    named = {
+        token.strip().lower()
+        for value in headers.getall('Connection', ())
+        for token in value.split(',')
+    }
+    return HOP_BY_HOP.union(named) if named else HOP_BY_HOP
+
+def _tune_tunnel_socket(sock) -> None:
+    """Disable Nagle and enlarge kernel buffers on a tunnel socket"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TUNNEL_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TUNNEL_BUFFER_SIZE)
+
+@functools.lru_cache(maxsize=8192)
+def _extract_host(host: str) -> str:
+    """Normalize a host with tldextract, memoized per host"""
+    ext = _tld(host)
+    return '.'.join(
+        part for part in (ext.subdomain, ext.domain, ext.suffix) if part
+    ).lower()
+
+async def _connect_tunnel_socket(host: str, port: int) -> socket.socket:
+    """Open a tuned, non-blocking TCP connection to a CONNECT target"""
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    error: Optional[OSError] = None
+    for family, type_, proto, _, address in infos:
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        _tune_tunnel_socket(sock)
+        try:
+            await loop.sock_connect(sock, address)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error or OSError(f"Could not resolve {host}")
+
+async def _splice_to_client(dest_socket: socket.socket, transport, write) -> None:
+    """Move bytes from the target socket to the client with os.splice
+
+    Data goes through a pipe without being copied into Python. Whenever the
+    client socket is full, or aiohttp's transport still has buffered output,
+    the pending bytes are read out of the pipe and handed to ``write`` so
+    ordering and backpressure stay with the transport.
+
+    Both sockets are used through duplicated fds. Once the transport closes
+    its own fd the kernel may hand that number to a new connection, so the
+    original client fd must never be written to after that point.
+    """
+    loop = asyncio.get_running_loop()
+    dest_fd = os.dup(dest_socket.fileno())
+    client_fd = os.dup(transport.get_extra_info('socket').fileno())
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    pipe_r, pipe_w = os.pipe2(os.O_NONBLOCK)
+    readable = asyncio.Event()
+    loop.add_reader(dest_fd, readable.set)
+    try:
+        while not transport.is_closing():
+            try:
+                pending = os.splice(dest_fd, pipe_w, TUNNEL_BUFFER_SIZE, flags=flags)
+            except BlockingIOError:
+                readable.clear()
+                await readable.wait()
+                continue
+            if not pending:
+                break
+
+            while pending:
+                if transport.is_closing():
+                    return
+                if transport.get_write_buffer_size() == 0:
+                    try:
+                        pending -= os.splice(pipe_r, client_fd, pending, flags=flags)
+                        continue
+                    except BlockingIOError:
+                        pass
+                data = os.read(pipe_r, pending)
+                pending -= len(data)
+                await write(data)
+    except Exception as e:
+        logger.error(f"Forward error: {e}")
+    finally:
+        loop.remove_reader(dest_fd)
+        for fd in (pipe_r, pipe_w, client_fd, dest_fd):
+            os.close(fd)
+
+def _enqueue(queue: asyncio.Queue, data: str) -> None:
+    """Queue a message for a UI client, dropping its oldest one when full"""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(data)
+
+class _TunnelFeeder:
+    """Payload parser that hands raw tunnel bytes to a StreamReader
+
+    aiohttp stops parsing HTTP once a CONNECT is accepted; installing this
+    with ``request.protocol.set_parser`` (as WebSocketResponse does) routes
+    everything the client sends afterwards into ``reader``.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader):
+        self.reader = reader
+
+    def feed_data(self, data: bytes) -> tuple[bool, bytes]:
+        self.reader.feed_data(data)
+        return False, b''
+
+    def feed_eof(self) -> None:
+        self.reader.feed_eof()
+
 class ProxyServer:
     def __init__(self):
         self.blocked_domains = {'facebook.com', 'twitter.com'}
+        self._domain_trie: Dict[str, Any] = {}
+        for domain in self.blocked_domains:
+            self._add_domain(domain)
         self.blocked_keywords = {'gambling', 'adult'}
-        self.clients: Set[web.WebSocketResponse] = set()
+        self._ac = ahocorasick.Automaton()
+        self._ac_dirty = True
+        self._decision_cache: OrderedDict[str, tuple[bool, str]] = OrderedDict()
+        self.clients: Dict[web.WebSocketResponse, asyncio.Queue] = {}
+        self._rules_cache: Optional[str] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def _add_domain(self, domain: str) -> None:
+        """Insert a domain into the reversed-label suffix trie"""
+        labels = [label for label in reversed(domain.split('.')) if label]
+        if not labels:
+            return
+        node = self._domain_trie
+        for label in labels:
+            node = node.setdefault(label, {})
+        node[_TRIE_END] = domain
+
+    def _match_domain(self, host: str) -> Optional[str]:
+        """Return the blocked domain matching host or one of its parents"""
+        node = self._domain_trie
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                return None
+            if _TRIE_END in node:
+                return node[_TRIE_END]
+        return None
+
+    def _build_automaton(self) -> None:
+        """Rebuild the keyword automaton from the current keyword set"""
+        # The automaton already matches every keyword in one C-level pass;
+        # a Hyperscan database is no faster on inputs as short as URLs
+        self._ac = ahocorasick.Automaton()
+        for keyword in self.blocked_keywords:
+            self._ac.add_word(keyword, keyword)
+        if self.blocked_keywords:
+            self._ac.make_automaton()
+        self._ac_dirty = False
 
     def is_blocked(self, url: str) -> tuple[bool, str]:
+        """Return whether url is blocked and why, remembering recent URLs"""
         try:
-            # Extract domain
-            ext = tldextract.extract(url)
-            domain = f"{ext.domain}.{ext.suffix}"
+            decision = self._decision_cache.get(url)
+        except TypeError:
+            # Unhashable input, e.g. a list sent as a websocket test_url;
+            # _check_url turns it into an error decision
+            return self._check_url(url)
+        if decision is not None:
+            self._decision_cache.move_to_end(url)
+            return decision
+
+        decision = self._check_url(url)
+        self._decision_cache[url] = decision
+        if len(self._decision_cache) > DECISION_CACHE_SIZE:
+            self._decision_cache.popitem(last=False)
+        return decision
+
+    def _check_url(self, url: str) -> tuple[bool, str]:
+        try:
+            # Extract host; urlsplit already lowercases it, so tldextract is
+            # only needed for inputs without a scheme such as "example.com/x"
+            host = urlsplit(url).hostname
+            if host:
+                host = host.rstrip('.')
+            else:
+                host = _extract_host(url)
             
-            # Check domain blocks
-            if domain.lower() in {d.lower() for d in self.blocked_domains}:
+            # Check domain blocks, including subdomains of blocked domains
+            domain = self._match_domain(host)
+            if domain:
                 return True, f"Domain {domain} is blocked"
             
-            # Check keyword blocks
-            for keyword in self.blocked_keywords:
-                if keyword in url.lower():
-                    return True, f"Contains blocked keyword: {keyword}"
+            # Check keyword blocks in a single pass over the URL
+            if self._ac_dirty:
+                self._build_automaton()
+            if self._ac.kind == ahocorasick.AHOCORASICK:
+                hit = next(self._ac.iter(url.lower()), None)
+                if hit:
+                    return True, f"Contains blocked keyword: {hit[1]}"
             
             return False, "URL is allowed"
         except Exception as e:
             logger.error(f"Error checking URL: {e}")
             return True, f"Error checking URL: {str(e)}"
 
-    async def forward_request(self, request: web.Request) -> web.Response:
+    async def forward_request(self, request: web.Request) -> web.StreamResponse:
         """Handle HTTP forwarding"""
         target_url = f"http://{request.host}{request.path_qs}"
         logger.info(f"Forwarding request to: {target_url}")
@@ -45,84 +270,160 @@ class ProxyServer:
         if is_blocked:
             return web.Response(text=reason, status=403)
 
+        out = None
         try:
-            async with aiohttp.ClientSession() as session:
-                # Forward the request
-                method = request.method
-                headers = dict(request.headers)
-                body = await request.read()
-
-                async with session.request(
-                    method=method,
-                    url=target_url,
-                    headers=headers,
-                    data=body,
-                    allow_redirects=True
-                ) as response:
-                    content = await response.read()
-                    return web.Response(
-                        body=content,
-                        status=response.status,
-                        headers=response.headers
-                    )
+            # Forward the request
+            method = request.method
+            excluded = _hop_by_hop(request.headers)
+            headers = CIMultiDict(
+                (k, v) for k, v in request.headers.items()
+                if k.lower() not in excluded
+            )
+            body = await request.read()
+
+            async with self.session.request(
+                method=method,
+                url=target_url,
+                headers=headers,
+                data=body,
+                allow_redirects=True
+            ) as response:
+                # Stream the body through instead of buffering it, copying the
+                # end-to-end headers straight into the response's own dict
+                out = web.StreamResponse(status=response.status)
+                excluded = _hop_by_hop(response.headers)
+                out.headers.extend(
+                    (k, v) for k, v in response.headers.items()
+                    if k.lower() not in excluded
+                )
+                await out.prepare(request)
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    await out.write(chunk)
+                await out.write_eof()
+                return out
         except Exception as e:
             logger.error(f"Error forwarding request: {e}")
+            if out is not None and out.prepared:
+                # Headers are already sent; drop the connection so the body
+                # is never terminated and the client sees the truncation. The
+                # transport is already gone if the client disconnected first
+                transport = request.transport
+                if transport is not None:
+                    transport.abort()
+                return out
             return web.Response(text=str(e), status=500)
 
+    async def start_session(self, app: web.Application) -> None:
+        """Create the shared upstream client session"""
+        connector = aiohttp.TCPConnector(
+            limit=1024,
+            limit_per_host=64,
+            ttl_dns_cache=300,
+            use_dns_cache=True,
+            keepalive_timeout=75
+        )
+        # Bodies are streamed through as-is, so leave them compressed
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            auto_decompress=False
+        )
+
+    async def close_session(self, app: web.Application) -> None:
+        """Close the shared upstream client session"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
     async def handle_connect(self, request: web.Request) -> web.StreamResponse:
         """Handle HTTPS CONNECT tunneling"""
         try:
-            host, port = request.path.split(':')
-            port = int(port)
+            # Authority-form target, e.g. example.com:443 or [::1]:443
+            host, sep, port_s = request.raw_path.rpartition(':')
+            if not sep or not port_s.isdigit():
+                return web.Response(status=400, text="Invalid CONNECT target")
+            host = host.strip('[]')
+            port = int(port_s)
             
             # Check if domain is blocked
             is_blocked, reason = self.is_blocked(f"https://{host}")
             if is_blocked:
                 return web.Response(text=reason, status=403)
 
-            # Create connection to target
-            dest_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Connect to target without blocking the event loop
             try:
-                dest_socket.connect((host, port))
-            except socket.error as e:
+                dest_socket = await _connect_tunnel_socket(host, port)
+            except OSError as e:
                 logger.error(f"Failed to connect to target: {e}")
                 return web.Response(text=str(e), status=502)
+            _tune_tunnel_socket(request.transport.get_extra_info('socket'))
 
-            # Send connection established
-            client_socket = request.transport.get_extra_info('socket')
-            client_socket.send(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            # Send connection established; the connection belongs to the
+            # tunnel from here on, so it is closed once forwarding ends
+            response = web.StreamResponse(status=200, reason='Connection established')
+            response.force_close()
+            await response.prepare(request)
+            # Attaching the transport lets the reader pause the client while
+            # bytes wait for the target, so uploads go at the target's pace
+            client_reader = asyncio.StreamReader(limit=TUNNEL_BUFFER_SIZE)
+            client_reader.set_transport(request.transport)
+            feeder = _TunnelFeeder(client_reader)
+            request.protocol.set_parser(feeder)
 
             # Set up two-way forwarding
-            async def forward(source, destination):
+            async def forward(source, write):
                 try:
                     while True:
-                        data = await source.read(8192)
+                        data = await source.read(TUNNEL_BUFFER_SIZE)
                         if not data:
                             break
-                        destination.send(data)
+                        await write(data)
                 except Exception as e:
                     logger.error(f"Forward error: {e}")
 
-            # Create reader/writer pairs
-            client_reader = asyncio.StreamReader()
-            protocol = asyncio.StreamReaderProtocol(client_reader)
-            await asyncio.get_event_loop().create_connection(
-                lambda: protocol, sock=client_socket
-            )
+            loop = asyncio.get_running_loop()
+            if hasattr(os, 'splice'):
+                # Target -> client bytes stay in the kernel (socket -> pipe -> socket)
+                async def write_to_dest(data: bytes) -> None:
+                    await loop.sock_sendall(dest_socket, data)
 
-            dest_reader = asyncio.StreamReader()
-            protocol = asyncio.StreamReaderProtocol(dest_reader)
-            await asyncio.get_event_loop().create_connection(
-                lambda: protocol, sock=dest_socket
-            )
+                def end_dest() -> None:
+                    dest_socket.shutdown(socket.SHUT_WR)
 
-            # Start forwarding in both directions
-            await asyncio.gather(
-                forward(client_reader, dest_socket),
-                forward(dest_reader, client_socket)
-            )
+                close_dest = dest_socket.close
+                relay_to_client = _splice_to_client(
+                    dest_socket, request.transport, response.write
+                )
+            else:
+                dest_reader, dest_writer = await asyncio.open_connection(sock=dest_socket)
 
-            return web.Response()
+                async def write_to_dest(data: bytes) -> None:
+                    dest_writer.write(data)
+                    await dest_writer.drain()
+
+                def end_dest() -> None:
+                    if dest_writer.can_write_eof():
+                        dest_writer.write_eof()
+
+                close_dest = dest_writer.close
+                relay_to_client = forward(dest_reader, response.write)
+
+            async def client_to_dest():
+                await forward(client_reader, write_to_dest)
+                # Pass the client's half-close on to the target
+                try:
+                    end_dest()
+                except OSError:
+                    pass
+
+            # Relay the target until it closes, then tear down both sides
+            upstream = asyncio.create_task(client_to_dest())
+            try:
+                await relay_to_client
+            finally:
+                upstream.cancel()
+                close_dest()
+
+            return response
         except Exception as e:
             logger.error(f"CONNECT error: {e}")
             return web.Response(text=str(e), status=500)
@@ -140,39 +441,61 @@ class ProxyServer:
         """Handle WebSocket connections for UI"""
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        self.clients.add(ws)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.clients[ws] = queue
+        sender = asyncio.create_task(self._sender(ws, queue))
         
         try:
             # Send initial rules
-            await ws.send_json({
-                'type': 'rules',
-                'blockedDomains': list(self.blocked_domains),
-                'blockedKeywords': list(self.blocked_keywords)
-            })
+            _enqueue(queue, self.rules_message())
             
             async for msg in ws:
                 if msg.type == aiohttp.WSMsgType.TEXT:
                     try:
-                        data = msg.json()
+                        data = orjson.loads(msg.data)
                         if data['type'] == 'test_url':
                             is_blocked, reason = self.is_blocked(data['url'])
-                            await ws.send_json({
+                            _enqueue(queue, orjson.dumps({
                                 'type': 'test_result',
                                 'url': data['url'],
                                 'blocked': is_blocked,
                                 'reason': reason
-                            })
+                            }).decode())
                     except Exception as e:
                         logger.error(f"WebSocket message error: {e}")
         finally:
-            self.clients.remove(ws)
+            sender.cancel()
+            self.clients.pop(ws, None)
         
         return ws
 
+    def rules_message(self) -> str:
+        """Return the serialized rules message, encoding it once per change"""
+        if self._rules_cache is None:
+            self._rules_cache = orjson.dumps({
+                'type': 'rules',
+                'blockedDomains': list(self.blocked_domains),
+                'blockedKeywords': list(self.blocked_keywords)
+            }).decode()
+        return self._rules_cache
+
+    async def _sender(self, ws: web.WebSocketResponse, queue: asyncio.Queue) -> None:
+        """Write queued messages to one UI client"""
+        try:
+            while True:
+                await ws.send_str(await queue.get())
+        except Exception as e:
+            logger.error(f"WebSocket send error: {e}")
+
+    def broadcast(self, data: str) -> None:
+        """Queue a serialized message for every UI client without waiting"""
+        for queue in self.clients.values():
+            _enqueue(queue, data)
+
     async def add_rule(self, request: web.Request) -> web.Response:
         """Handle adding new blocking rules"""
         try:
-            data = await request.json()
+            data = await request.json(loads=orjson.loads)
             rule_type = data.get('type')
             value = data.get('value', '').lower().strip()
             
@@ -181,18 +504,17 @@ class ProxyServer:
             
             if rule_type == 'domain':
                 self.blocked_domains.add(value)
+                self._add_domain(value)
             elif rule_type == 'keyword':
                 self.blocked_keywords.add(value)
+                self._ac_dirty = True
             else:
                 return web.Response(status=400, text="Invalid rule type")
+            self._rules_cache = None
+            self._decision_cache.clear()
             
             # Notify all clients of the update
-            for client in self.clients:
-                await client.send_json({
-                    'type': 'rules',
-                    'blockedDomains': list(self.blocked_domains),
-                    'blockedKeywords': list(self.blocked_keywords)
-                })
+            self.broadcast(self.rules_message())
             
             return web.Response(text='OK')
         except Exception as e:
@@ -203,29 +525,49 @@ async def init_app() -> web.Application:
     app = web.Application()
     proxy = ProxyServer()
     
-    # CORS middleware
+    # Load the suffix list now rather than on the first request
+    _tld('example.com')
+    
+    # CONNECT targets are authority-form (host:port) and never match a route
+    # path, so send them to the proxy before routing can answer 404
     @web.middleware
-    async def cors_middleware(request: web.Request, handler):
-        if request.method == 'OPTIONS':
-            return web.Response(headers={
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': '*',
-                'Access-Control-Allow-Headers': '*',
-            })
-        
-        response = await handler(request)
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        return response
+    async def connect_middleware(request: web.Request, handler):
+        if request.method == 'CONNECT':
+            return await proxy.proxy_handler(request)
+        return await handler(request)
+    
+    app.middlewares.append(connect_middleware)
+    
+    # CORS only applies to the UI's fetch() calls, so proxied traffic
+    # skips it instead of going through a global middleware
+    async def cors_preflight(request: web.Request) -> web.Response:
+        return web.Response(headers=_PREFLIGHT_HEADERS)
+    
+    def with_cors(handler):
+        async def cors_handler(request: web.Request) -> web.StreamResponse:
+            response = await handler(request)
+            response.headers['Access-Control-Allow-Origin'] = _ACAO
+            return response
+        return cors_handler
     
-    app.middlewares.append(cors_middleware)
+    # Reuse one upstream session for every forwarded request
+    app.on_startup.append(proxy.start_session)
+    app.on_cleanup.append(proxy.close_session)
     
     app.router.add_get('/ws', proxy.websocket_handler)
-    app.router.add_post('/add-rule', proxy.add_rule)
+    app.router.add_post('/add-rule', with_cors(proxy.add_rule))
+    app.router.add_route('OPTIONS', '/add-rule', cors_preflight)
     app.router.add_route('*', '/{path:.*}', proxy.proxy_handler)
     
     return app
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
+    try:
+        import uvloop
+        loop = uvloop.new_event_loop()
+    except ImportError:
+        logger.info("uvloop not available, using the default event loop")
+        loop = None
     app = init_app()
-    web.run_app(app, port=8888)
\ No newline at end of file
+    web.run_app(app, port=8888, loop=loop)
\ No newline at end of file
@@ -0,0 +1,138 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+
+from proxy_server import init_app
+
+
+class ProxyAppTestCase(unittest.IsolatedAsyncioTestCase):
+    """Base case serving the real app from init_app() on a local port"""
+
+    async def asyncSetUp(self):
+        self.runner = web.AppRunner(await init_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.proxy_port = self.runner.addresses[0][1]
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+
+class ConnectTunnelTest(ProxyAppTestCase):
+    """CONNECT requests sent through the real app, not a mocked router"""
+
+    async def asyncSetUp(self):
+        async def echo(reader, writer):
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        self.target = await asyncio.start_server(echo, '127.0.0.1', 0)
+        self.target_port = self.target.sockets[0].getsockname()[1]
+        await super().asyncSetUp()
+
+    async def asyncTearDown(self):
+        await super().asyncTearDown()
+        self.target.close()
+        await self.target.wait_closed()
+
+    async def connect(self, target: str):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.proxy_port)
+        writer.write(f'CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n'.encode())
+        await writer.drain()
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        return head.split(b'\r\n')[0], reader, writer
+
+    async def test_tunnel_relays_both_ways(self):
+        status, reader, writer = await self.connect(f'127.0.0.1:{self.target_port}')
+        self.assertEqual(status, b'HTTP/1.1 200 Connection established')
+
+        payload = b'x' * 300000
+        writer.write(payload)
+        await writer.drain()
+        echoed = await asyncio.wait_for(reader.readexactly(len(payload)), 5)
+        self.assertEqual(echoed, payload)
+        writer.close()
+
+    async def test_blocked_domain_is_refused(self):
+        status, _, writer = await self.connect('facebook.com:443')
+        self.assertEqual(status, b'HTTP/1.1 403 Forbidden')
+        writer.close()
+
+    async def test_target_without_port_is_rejected(self):
+        status, _, writer = await self.connect('example.com')
+        self.assertEqual(status, b'HTTP/1.1 400 Bad Request')
+        writer.close()
+
+
+class ForwardStreamTest(ProxyAppTestCase):
+    """Streamed HTTP forwarding when either side goes away mid-body"""
+
+    async def upstream(self, handle):
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        return server.sockets[0].getsockname()[1]
+
+    async def get(self, port: int):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.proxy_port)
+        writer.write(f'GET /file HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n\r\n'.encode())
+        await writer.drain()
+        return reader, writer
+
+    async def test_upstream_cut_leaves_body_unterminated(self):
+        async def cut(reader, writer):
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                         b'7\r\npartial\r\n')
+            await writer.drain()
+            writer.close()
+
+        reader, writer = await self.get(await self.upstream(cut))
+        received = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+
+        head, _, body = received.partition(b'\r\n\r\n')
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK'))
+        self.assertIn(b'partial', body)
+        self.assertNotIn(b'0\r\n\r\n', body)
+
+    async def test_client_disconnect_raises_no_handler_error(self):
+        client_gone = asyncio.Event()
+        released = asyncio.Event()
+
+        async def stalled(reader, writer):
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n')
+            chunk = b'%x\r\n%s\r\n' % (65536, b'x' * 65536)
+            try:
+                writer.write(chunk * 4)
+                await writer.drain()
+                # Hold the rest back until the client has disconnected, so the
+                # proxy's next write lands after its transport is released
+                await client_gone.wait()
+                while True:
+                    writer.write(chunk)
+                    await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                released.set()
+                writer.close()
+
+        port = await self.upstream(stalled)
+        with self.assertNoLogs('aiohttp.server', 'ERROR'):
+            reader, writer = await self.get(port)
+            await asyncio.wait_for(reader.readexactly(200000), 5)
+            writer.transport.abort()
+            await asyncio.sleep(0.1)
+            client_gone.set()
+            await asyncio.wait_for(released.wait(), 5)
+            await asyncio.sleep(0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()